@@ -5,64 +5,90 @@ Extracts passphrases for SSH private keys from Bitwarden vault
 Then adds them to ssh-agent
 """
 
-from typing import Dict
-import csv
+from typing import Dict, Set
 import pathlib
 import config
-import argparse
 import json
 import logging
 import os
+import pty
+import re
+import select
 import subprocess
+import sys
+import termios
 
-from importlib.metadata import version
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 
-# Use this constant to call `bw` in shell
-# Necessary to fix `bw` deprecation warning for punycode 
+# Use this environment to call `bw`
+# Necessary to fix `bw` deprecation warning for punycode
 # https://github.com/bitwarden/clients/issues/6689
-BW_SHELL_CALL = "NODE_OPTIONS=\"--no-deprecation\" bw"
+BW_ENV = {**os.environ, "NODE_OPTIONS": "--no-deprecation"}
 
+# Listing items is the hot path, so it may be pointed at a faster
+# `bw`-compatible CLI in config. Login, unlock and sync always use `bw`
+BW_ITEMS_CLI = getattr(config, "BW_ITEMS_CLI", "bw")
 
-def memoize(func):
+# Prompts printed by `ssh-add` when it needs a passphrase for a key
+SSH_ADD_PROMPT = re.compile(
+    rb"(?P<retry>Bad passphrase, try again|Enter passphrase) for (?P<path>.+?)(?: \(will confirm each use\))?: $"
+)
+# Seconds to wait for `ssh-add` output before giving up on the call
+SSH_ADD_TIMEOUT = 5
+
+
+def run_bw(*args, session=None, cli="bw", **kwargs):
     """
-    Decorator function to cache the results of another function call
+    Function to run a Bitwarden CLI command
+
+    The session is handed over in BW_SESSION rather than `--session`, so
+    it doesn't show up in the process list
     """
-    cache = dict()
+    env = BW_ENV if session is None else {**BW_ENV, "BW_SESSION": session}
+    return subprocess.run([cli, *args], env=env, **kwargs)
 
-    def memoized_func(*args):
-        if args in cache:
-            return cache[args]
-        result = func(*args)
-        cache[args] = result
-        return result
 
-    return memoized_func
+def read_mapping(csv_path) -> Dict[str, pathlib.Path]:
+    """
+    Function to read the `itemId,path_to_key` mapping, skipping blank lines
+    """
+    import csv
+
+    with open(csv_path, encoding="utf-8", newline="") as csv_file:
+        return {row[0]: pathlib.Path(row[1]).expanduser() for row in csv.reader(csv_file) if row}
 
 
-@memoize
+def parse_version(version_string):
+    """
+    Function to turn a version string like "2024.1.0" into a comparable tuple
+    """
+    return tuple(int(part) for part in re.findall(r"\d+", version_string))
+
+
+@lru_cache(maxsize=None)
 def bwcli_version():
     """
     Function to return the version of the Bitwarden CLI
     """
-    proc_version = subprocess.run(
-        [f"{BW_SHELL_CALL} --version"],
+    proc_version = run_bw(
+        "--version",
         stdout=subprocess.PIPE,
         universal_newlines=True,
         check=True,
-        shell=True
     )
     return proc_version.stdout
 
 
-@memoize
+@lru_cache(maxsize=None)
 def cli_supports(feature):
     """
     Function to return whether the current Bitwarden CLI supports a particular
     feature
     """
-    version = version(bwcli_version())
+    cli_version = parse_version(bwcli_version())
 
-    if feature == "nointeraction" and version >= version("1.9.0"):
+    if feature == "nointeraction" and cli_version >= parse_version("1.9.0"):
         return True
     return False
 
@@ -78,7 +104,7 @@ def get_session():
         return session
 
     # Check if we're already logged in
-    proc_logged = subprocess.run(f"{BW_SHELL_CALL} login --check --quiet {config.EMAIL}", shell=True)
+    proc_logged = run_bw("login", "--check", "--quiet", config.EMAIL)
 
     if proc_logged.returncode:
         logging.debug("Not logged into Bitwarden")
@@ -86,74 +112,221 @@ def get_session():
     else:
         logging.debug("Bitwarden vault is locked")
         operation = "unlock"
-    
-    proc_session = subprocess.run(
-        f"{BW_SHELL_CALL} --raw {operation}",
+
+    proc_session = run_bw(
+        "--raw",
+        operation,
         stdout=subprocess.PIPE,
         universal_newlines=True,
         check=True,
-        shell=True
     )
     return proc_session.stdout
 
 
-def folder_items(session, folder_id):
+def folder_items(session, folder_ids):
     """
-    Function to return items from a folder
+    Function to return items from one or more folders
+
+    Several folders are served by a single `list items` call filtered
+    locally, so the vault is listed and decrypted only once
     """
-    logging.debug("Folder ID: %s" % folder_id)
+    logging.debug("Folder IDs: %s", folder_ids)
+
+    if len(folder_ids) == 1:
+        folder_args = ["--folderid", folder_ids[0]]
+    else:
+        folder_args = []
+
+    proc_items = run_bw(
+        "list",
+        "items",
+        *folder_args,
+        session=session,
+        cli=BW_ITEMS_CLI,
+        stdout=subprocess.PIPE,
+        check=True,
+    )
+    # Bytes are passed straight to json.loads, without newline translation
+    items = json.loads(proc_items.stdout)
+    if folder_args:
+        return items
+    return [item for item in items if item["folderId"] in folder_ids]
 
-    proc_items = subprocess.run(
-        f"BW_SESSION={session} {BW_SHELL_CALL} list items --folderid {folder_id}",
+
+def loaded_fingerprints():
+    """
+    Function to return the fingerprints of keys already in ssh-agent
+    """
+    proc_list = subprocess.run(
+        ["ssh-add", "-l"],
         stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
         universal_newlines=True,
-        check=True,
-        shell=True
     )
-    return json.loads(proc_items.stdout)
+    # Exits with 1 if the agent has no keys and 2 if there is no agent
+    if proc_list.returncode:
+        return set()
+    return {line.split()[1] for line in proc_list.stdout.splitlines()}
 
 
-def add_ssh_keys(session, items, itemid_path_pair: Dict[str, pathlib.Path]):
+def key_fingerprint(path):
+    """
+    Function to return the fingerprint of a private key, or None if it
+    can't be read without its passphrase
+    """
+    proc_fingerprint = subprocess.run(
+        ["ssh-keygen", "-l", "-f", str(path)],
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+        universal_newlines=True,
+    )
+    if proc_fingerprint.returncode:
+        return None
+    return proc_fingerprint.stdout.split()[1]
+
+
+def ssh_add(passphrases: Dict[str, str], added: Set[str]):
+    """
+    Add keys with a single `ssh-add` call, answering each passphrase prompt
+    through a pseudo-terminal as soon as it appears
+
+    Paths that `ssh-add` reports as added are put into `added`. Returns
+    False if `ssh-add` stopped responding before it was done
+    """
+
+    def report(line):
+        line = line.decode(errors="replace").rstrip()
+        print(line)
+        prefix = "Identity added: "
+        if line.startswith(prefix):
+            added.update(path for path in passphrases if line[len(prefix):].startswith(path + " "))
+
+    master_fd, slave_fd = pty.openpty()
+    # `ssh-add` only turns off echo on a terminal it opened itself, so make
+    # sure the passphrases we write are not echoed back
+    attrs = termios.tcgetattr(slave_fd)
+    attrs[3] &= ~termios.ECHO
+    termios.tcsetattr(slave_fd, termios.TCSANOW, attrs)
+    # In a new session `ssh-add` has no controlling terminal, so it reads
+    # passphrases from stdin and prompts on stderr, both being our pty
+    proc = subprocess.Popen(
+        ["ssh-add", *passphrases],
+        stdin=slave_fd,
+        stdout=slave_fd,
+        stderr=slave_fd,
+        start_new_session=True,
+    )
+    os.close(slave_fd)
+
+    output = b""
+    try:
+        while True:
+            ready, _, _ = select.select([master_fd], [], [], SSH_ADD_TIMEOUT)
+            if not ready:
+                proc.kill()
+                return False
+            try:
+                chunk = os.read(master_fd, 1024)
+            except OSError:
+                # Linux raises EIO once `ssh-add` exits and closes the pty
+                chunk = b""
+            if not chunk:
+                break
+            output += chunk
+            *lines, output = output.split(b"\n")
+            for line in lines:
+                if line.strip():
+                    report(line)
+
+            prompt = SSH_ADD_PROMPT.search(output)
+            if prompt is None:
+                continue
+            output = b""
+            path = prompt["path"].decode()
+            # An empty answer makes `ssh-add` skip the key
+            if path not in passphrases:
+                logging.warning("Unexpected passphrase prompt for %s", path)
+                os.write(master_fd, b"\n")
+            elif prompt["retry"].startswith(b"Bad"):
+                logging.warning("Wrong passphrase for %s", path)
+                os.write(master_fd, b"\n")
+            else:
+                os.write(master_fd, passphrases[path].encode() + b"\n")
+    finally:
+        os.close(master_fd)
+        proc.wait()
+
+    if output.strip():
+        report(output)
+    if proc.returncode:
+        logging.warning("Could not add key to the SSH agent")
+    return True
+
+
+def add_ssh_keys(session, items, itemid_path_pair: Dict[str, pathlib.Path], existing: Set[pathlib.Path]):
     """
     Add all possible keys with corresponding passphrases to ssh-add
+
+    `items` must only contain items mapped in `itemid_path_pair`, and
+    `existing` holds the mapped private key paths found on disk
     """
+    candidates = {}
     for item in items:
         passphrase = item["login"]["password"]
-        try:
-            path = itemid_path_pair[item["id"]]
-        except KeyError:
-            print("Path for item %s not found" % item["name"])
-            continue
+        path = itemid_path_pair[item["id"]]
         if passphrase is None:
-            print("Passphrase not found for %s" % item["name"])
+            logging.warning("Passphrase not found for %s", item["name"])
             continue
-        if not path.exists():
-            print("Private key at %s does not exist" % path)
+        if path not in existing:
+            logging.warning("Private key at %s does not exist", path)
             continue
-        try:
-            # sleep .3; echo testing; } | script -q /dev/null ssh-add testing_key
-            subprocess.run(
-                ["{ sleep .3; echo %s; } | script -q /dev/null ssh-add %s" % (passphrase, path)],
-                universal_newlines=True,
-                shell=True,
-                check=True,
-            )
-        except subprocess.SubprocessError:
-            logging.warning("Could not add key to the SSH agent")
+        candidates[path] = passphrase
+
+    if not candidates:
+        return
+
+    loaded = loaded_fingerprints()
+    passphrases = {}
+    for path, passphrase in candidates.items():
+        if loaded and key_fingerprint(path) in loaded:
+            logging.debug("Private key at %s is already in ssh-agent", path)
+            continue
+        passphrases[str(path)] = passphrase
+
+    if not passphrases:
+        return
+
+    added = set()
+    if not ssh_add(passphrases, added):
+        logging.warning("ssh-add did not respond, adding keys one by one")
+        # Only retry keys the batch didn't get to. Each key gets its own
+        # `ssh-add` and pty, so their start-up and KDF work can overlap
+        remaining = [path for path in passphrases if path not in added]
+        if not remaining:
+            return
+        with ThreadPoolExecutor(max_workers=min(8, len(remaining))) as executor:
+            responded = executor.map(lambda path: ssh_add({path: passphrases[path]}, added), remaining)
+            for path, ok in zip(remaining, responded):
+                if not ok:
+                    logging.warning("ssh-add did not respond for %s", path)
 
 
 def lock_bitwarden(session):
     """
     Lock Bitwarden after all is done
     """
-    subprocess.run(
-        f"BW_SESSION={session} {BW_SHELL_CALL} lock",
-        stdout=subprocess.PIPE,
-        universal_newlines=True,
-        check=True,
-        shell=True
-    )
-    return None
+    try:
+        run_bw(
+            "lock",
+            session=session,
+            stdout=subprocess.DEVNULL,
+            check=True,
+        )
+    except subprocess.CalledProcessError as e:
+        logging.error("Could not lock Bitwarden: `%s` exited with %s", e.cmd[0], e.returncode)
+    except OSError as e:
+        logging.error("Could not lock Bitwarden: could not run `%s`: %s", e.filename, e.strerror)
 
 
 if __name__ == "__main__":
@@ -162,6 +335,8 @@ if __name__ == "__main__":
         """
         Function to parse command line arguments
         """
+        import argparse
+
         parser = argparse.ArgumentParser()
         parser.add_argument(
             "-d",
@@ -177,47 +352,64 @@ if __name__ == "__main__":
         Main program logic
         """
 
-        args = parse_args()
+        # Plain runs have nothing to parse, so skip importing argparse
+        debug = len(sys.argv) > 1 and parse_args().debug
 
-        if args.debug:
+        if debug:
             loglevel = logging.DEBUG
         else:
             loglevel = logging.INFO
 
         logging.basicConfig(level=loglevel)
 
-        itemid_path_pair = {}
         try:
-            with open(config.ITEM_ID_KEY_MAPPING_CSV) as csv_file:
-                reader = csv.reader(csv_file)
-                for row in reader:
-                    itemid_path_pair[row[0]] = pathlib.Path(row[1]).expanduser()
+            itemid_path_pair = read_mapping(config.ITEM_ID_KEY_MAPPING_CSV)
         except Exception:
-            print("CSV file was not loaded correctly")
+            logging.error("CSV file was not loaded correctly")
             exit()
 
+        # Stat each mapped key once, even if several items share it
+        existing = {path for path in set(itemid_path_pair.values()) if path.exists()}
+
+        # FOLDER_ID may be a single folder or a list of them
+        folder_ids = config.FOLDER_ID
+        if isinstance(folder_ids, str):
+            folder_ids = [folder_ids]
+        folder_ids = tuple(dict.fromkeys(folder_ids))
+
         session = None
 
         try:
             logging.info("Getting Bitwarden session")
             session = get_session()
-            logging.debug("Session = %s" % session)
+            logging.debug("Session = %s", session)
 
             # Sync bw vault before retrieving keys
-            subprocess.run(
-                f"BW_SESSION={session} {BW_SHELL_CALL} sync", stdout=subprocess.PIPE, universal_newlines=True, check=True, shell=True
+            run_bw(
+                "sync",
+                session=session,
+                stdout=subprocess.DEVNULL,
+                check=True,
             )
 
             logging.info("Getting folder items")
-            items = folder_items(session, config.FOLDER_ID)
+            items = []
+            for item in folder_items(session, folder_ids):
+                if item["id"] in itemid_path_pair:
+                    items.append(item)
+                else:
+                    logging.warning("Path for item %s not found", item["name"])
 
             logging.info("Attempting to add keys to ssh-agent")
-            add_ssh_keys(session, items, itemid_path_pair)
+            add_ssh_keys(session, items, itemid_path_pair, existing)
 
         except subprocess.CalledProcessError as e:
             if e.stderr:
-                logging.error("`%s` error: %s" % (e.cmd[0], e.stderr))
-            logging.debug("Error running %s" % e.cmd)
+                logging.error("`%s` error: %s", e.cmd[0], e.stderr)
+            logging.debug("Error running %s", e.cmd)
+        except OSError as e:
+            # Without a shell, a missing executable raises instead of exiting 127
+            logging.error("Could not run `%s`: %s", e.filename, e.strerror)
         finally:
             if session:
                 lock_bitwarden(session)